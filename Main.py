@@ -1,77 +1,221 @@
 import streamlit as st
 import pandas as pd
-import re
+import numpy as np
+import io
 import math
 
-st.title("WEC/IMSA Pace Analyser")
+from pace_utils import parse_clock, sort_car_numbers, top_laps_stats
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+required_cols = [
+    "NUMBER","LAP_TIME","CLASS","MANUFACTURER","ELAPSED",
+    "DRIVER_NAME","TEAM","TOP_SPEED","CROSSING_FINISH_LINE_IN_PIT","LAP_NUMBER"
+]
+
+
+def format_lap_times(seconds):
+    minutes = (seconds//60).astype("Int64").astype(str)
+    secs = (seconds%60).map("{:06.3f}".format).astype(str)
+    text = minutes + ":" + secs
+    return text.where(seconds.notna(), "N/A")
+
+
+def read_csv_chunks(file_bytes, usecols):
+    # One parsed block of the upload at a time
+    if pa is not None:
+        reader = pacsv.open_csv(
+            io.BytesIO(file_bytes),
+            read_options=pacsv.ReadOptions(block_size=8<<20),
+            parse_options=pacsv.ParseOptions(delimiter=';'),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=usecols,
+                column_types={c: pa.string() for c in usecols},
+                strings_can_be_null=True
+            )
+        )
+        for batch in reader:
+            yield batch.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get)
+    else:
+        yield from pd.read_csv(io.BytesIO(file_bytes), sep=';', header=0, usecols=usecols, dtype=str, chunksize=100_000)
 
-uploaded_files = st.file_uploader("Upload one or more CSV files", type="csv", accept_multiple_files=True)
 
-if uploaded_files:
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_and_prepare(file_bytes):
+    # Header only, to pick the columns to read
+    header = pd.read_csv(io.BytesIO(file_bytes), sep=';', nrows=0).columns
+    usecols = [c for c in header if c.strip() in required_cols]
+
+    missing_cols = [c for c in required_cols if c not in [c.strip() for c in usecols]]
+
+    if missing_cols:
+        raise ValueError(f"Missing required column(s): {', '.join(missing_cols)}")
+
+    chunks = []
+
+    for df in read_csv_chunks(file_bytes, usecols):
+        df.columns = [c.strip() for c in df.columns]
+
+        hours, minutes, seconds = parse_clock(df["LAP_TIME"])
+        df["lap_seconds"] = hours*3600 + minutes*60 + seconds
+
+        hours, minutes, seconds = parse_clock(df["ELAPSED"])
+        df["elapsed_hours"] = (hours + minutes/60 + seconds/3600).astype("float32")
+
+        df["TOP_SPEED"] = pd.to_numeric(df["TOP_SPEED"], errors='coerce').astype("float64")
+
+        # Pit crossings and the opening lap never count
+        in_pit = df["CROSSING_FINISH_LINE_IN_PIT"].fillna("").str.strip().str.upper()=="B"
+        lap_number = pd.to_numeric(df["LAP_NUMBER"], errors='coerce')
+        df["racing_lap"] = (~in_pit & (lap_number>1)).to_numpy(dtype=bool, na_value=False)
+
+        chunks.append(df.drop(columns=["LAP_TIME","ELAPSED","CROSSING_FINISH_LINE_IN_PIT","LAP_NUMBER"]))
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def combine_sessions(_files, data_key):
+    # _files is not hashed; data_key holds their file ids
 
     dfs = []
+    errors = []
 
-    for file in uploaded_files:
+    for file in _files:
         try:
-            df_part = pd.read_csv(file, sep=';', engine='python', header=0, dtype=str)
-            df_part.columns = [c.strip() for c in df_part.columns]
-            dfs.append(df_part)
+            dfs.append(load_and_prepare(file.getvalue()))
         except Exception as e:
-            st.error(f"Failed to read {file.name}: {e}")
+            errors.append(f"Failed to read {file.name}: {e}")
 
-    df = pd.concat(dfs, ignore_index=True)
+    if not dfs:
+        return None, errors
 
-    required_cols = [
-        "NUMBER","LAP_TIME","CLASS","MANUFACTURER","ELAPSED",
-        "DRIVER_NAME","TEAM","TOP_SPEED","CROSSING_FINISH_LINE_IN_PIT","LAP_NUMBER"
-    ]
+    df = dfs[0] if len(dfs)==1 else pd.concat(dfs, ignore_index=True)
 
-    missing_cols = [c for c in required_cols if c not in df.columns]
+    df["CLASS"] = df["CLASS"].str.strip().str.upper()
 
-    if missing_cols:
-        st.error(f"Missing required column(s): {', '.join(missing_cols)}")
+    for col in ("NUMBER","CLASS","MANUFACTURER","DRIVER_NAME","TEAM"):
+        df[col] = df[col].astype("category")
+
+    # Car categories in numeric order ("7" before "10")
+    df["NUMBER"] = df["NUMBER"].cat.reorder_categories(sort_car_numbers(df["NUMBER"].cat.categories))
+
+    return df, errors
 
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def filter_laps(_df, data_key, target_class, selected_cars, hour_range):
+    # _df is not hashed; data_key identifies it
+
+    df = _df
+
+    session = (
+        df["NUMBER"].isin(selected_cars) &
+        (df["CLASS"]==target_class) &
+        df["racing_lap"]
+    ).to_numpy(dtype=bool, na_value=False)
+
+    df_full_session = df[session]
+
+    elapsed = df["elapsed_hours"].to_numpy()
+    lo, hi = hour_range
+
+    if ne is not None:
+        in_window = ne.evaluate("session & (elapsed>=lo) & (elapsed<=hi)")
     else:
+        in_window = session & (elapsed>=lo) & (elapsed<=hi)
+
+    df_class = df[in_window]
+
+    return df_full_session, df_class
+
+
+def format_speeds(speeds):
+    text = speeds.map("{:.1f}".format, na_action="ignore").astype(str)
+    return text.where(speeds.notna(), "N/A")
+
 
-        df = df[required_cols]
+@st.cache_data(show_spinner=False, max_entries=64)
+def compute_results(_df_class, _df_full_session, filter_key, key, target_percent, max_delta):
+    # The frames are not hashed; filter_key identifies them
 
-        time_re = re.compile(r"(\d+):(\d{2}\.\d+)")
+    df_class, df_full_session = _df_class, _df_full_session
+
+    # Contiguous runs of laps per group, still in lap order
+    codes = df_class[key].cat.codes.to_numpy()
+    valid = codes>=0
+    codes = codes[valid]
+    lap = df_class["lap_seconds"].to_numpy(dtype=np.float64)[valid]
+    top_speed = df_class["TOP_SPEED"].to_numpy(dtype=np.float64)[valid]
+
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order].astype(np.int64)
+    starts = np.flatnonzero(np.diff(codes, prepend=-1))
+    offsets = np.append(starts, codes.size)
+
+    avg, avg_top_speed, laps = top_laps_stats(
+        lap[order], top_speed[order], offsets, target_percent,
+        np.inf if max_delta is None else float(max_delta)
+    )
+
+    summary = pd.DataFrame(
+        {"avg":avg, "laps":laps, "top_speed":avg_top_speed},
+        index=df_class[key].cat.categories[codes[starts]]
+    )
+
+    # Metadata from each group's first lap
+    groups = (
+        df_class[df_class[key].notna()]
+        .drop_duplicates(key)
+        .set_index(key, drop=False)[["NUMBER","TEAM","MANUFACTURER","DRIVER_NAME"]]
+    )
+    groups = groups.join(summary).join(df_full_session.groupby(key, observed=True, sort=False)["TOP_SPEED"].max().rename("best_top_speed"))
+
+    if key=="NUMBER":
+        # summary is already in car number order
+        groups = groups.loc[summary.index]
+
+    return pd.DataFrame({
+        "Car":"Multiple" if key=="MANUFACTURER" else groups["NUMBER"],
+        "Team":"Multiple" if key=="MANUFACTURER" else groups["TEAM"],
+        "Manufacturer":groups["MANUFACTURER"],
+        "Driver(s)":groups["DRIVER_NAME"] if key=="DRIVER_NAME" else "All",
+        "Average Lap Time":format_lap_times(groups["avg"]),
+        "Computed Laps":groups["laps"].fillna(0).astype(int),
+        "Average Top Speed":format_speeds(groups["top_speed"]),
+        "Best Top Speed":format_speeds(groups["best_top_speed"])
+    }).reset_index(drop=True)
+
+
+st.title("WEC/IMSA Pace Analyser")
 
-        def parse_time_to_seconds(t):
-            if pd.isna(t) or t == '':
-                return None
-            m = time_re.search(str(t).strip())
-            if not m:
-                return None
-            return int(m.group(1))*60 + float(m.group(2))
+uploaded_files = st.file_uploader("Upload one or more CSV files", type="csv", accept_multiple_files=True)
 
-        df["lap_seconds"] = df["LAP_TIME"].apply(parse_time_to_seconds)
+if uploaded_files:
 
-        elapsed_re = re.compile(r"(?:(\d+):)?(\d{1,2}):(\d{2}\.\d+)")
+    data_key = tuple(file.file_id for file in uploaded_files)
 
-        def parse_elapsed_to_hours(t):
-            if pd.isna(t) or t == '':
-                return None
-            m = elapsed_re.search(str(t).strip())
-            if not m:
-                return None
-            hours = int(m.group(1)) if m.group(1) else 0
-            minutes = int(m.group(2))
-            seconds = float(m.group(3))
-            return hours + minutes/60 + seconds/3600
+    df, errors = combine_sessions(uploaded_files, data_key)
 
-        df["elapsed_hours"] = df["ELAPSED"].apply(parse_elapsed_to_hours)
+    for message in errors:
+        st.error(message)
 
-        df["TOP_SPEED"] = pd.to_numeric(df["TOP_SPEED"], errors='coerce')
-        df["LAP_NUMBER"] = pd.to_numeric(df["LAP_NUMBER"], errors='coerce')
+    if df is not None:
 
         available_classes = df["CLASS"].dropna().unique()
 
         target_class = st.selectbox("Select car class", options=available_classes)
 
-        cars_in_class = df[df["CLASS"].str.upper()==str(target_class).upper()]["NUMBER"].dropna().unique()
-
-        cars_in_class_sorted = sorted(cars_in_class, key=lambda x: int(re.sub(r"\D","",x)))
+        cars_in_class_sorted = df.loc[df["CLASS"]==target_class, "NUMBER"].dropna().unique().sort_values().tolist()
 
         with st.expander("Cars"):
             selected_cars = st.multiselect(
@@ -81,20 +225,18 @@ if uploaded_files:
                 help="Here you can exclude cars from the analysis."
             )
 
-        df = df[df["NUMBER"].isin(selected_cars)]
+        elapsed_hours = df.loc[df["NUMBER"].isin(selected_cars), "elapsed_hours"]
 
         target_percent = st.slider(
             "Top % laps",0.1,0.7,0.6,0.05,
             help="Lower values filter only the fastest laps."
         )
 
-        session_start_hour = max(0,math.floor(df["elapsed_hours"].min()))
+        session_start_hour = max(0,math.floor(elapsed_hours.min()))
 
-        elapsed_hours_sorted = df["elapsed_hours"].sort_values()
+        max_full_hour = math.floor(elapsed_hours.max())
 
-        max_full_hour = math.floor(elapsed_hours_sorted.max())
-
-        laps_beyond_next = sum(elapsed_hours_sorted>(max_full_hour+1))
+        laps_beyond_next = (elapsed_hours>(max_full_hour+1)).sum()
 
         if laps_beyond_next>=2:
             max_elapsed_hour = max_full_hour+1
@@ -110,8 +252,6 @@ if uploaded_files:
             format="%.1f"
         )
 
-        df_time_filtered = df[(df["elapsed_hours"]>=hour_range[0]) & (df["elapsed_hours"]<=hour_range[1])]
-
         max_delta = st.number_input(
             "Laptime range (s)",
             min_value=0,
@@ -125,128 +265,19 @@ if uploaded_files:
         avg_by_manufacturer = st.checkbox("Manufacturer average")
         avg_by_driver = st.checkbox("Individual driver performance")
 
-        df["CLASS_clean"] = df["CLASS"].astype(str).str.upper().str.strip()
-
-        mask_class = df["CLASS_clean"]==str(target_class).upper()
-        mask_no_pit = ~(df["CROSSING_FINISH_LINE_IN_PIT"].astype(str).str.upper().str.strip()=="B")
-        mask_not_first_lap = df["LAP_NUMBER"]>1
-
-        df_full_session = df[mask_class & mask_no_pit & mask_not_first_lap].copy()
-
-        df_class = df_time_filtered[
-            (df_time_filtered["CLASS"].str.upper()==str(target_class).upper()) &
-            ~(df_time_filtered["CROSSING_FINISH_LINE_IN_PIT"].astype(str).str.upper()=="B") &
-            (df_time_filtered["LAP_NUMBER"]>1)
-        ].copy()
-
-        results = []
-
-        def process_subset(subset, full_subset, entity_name, car_name, team_name, manufacturer_name):
-
-            subset_sorted = subset.sort_values("lap_seconds")
-
-            cutoff = max(1,int(len(subset_sorted)*target_percent))
-
-            best_idx = subset_sorted.index[:cutoff]
-
-            best_times = subset_sorted.loc[best_idx,"lap_seconds"].to_list()
-
-            if max_delta is not None and len(best_times)>0:
-                best_lap = min(best_times)
-                best_idx = [i for i in best_idx if subset_sorted.loc[i,"lap_seconds"]<=best_lap+max_delta]
-                best_times = subset_sorted.loc[best_idx,"lap_seconds"].to_list()
-
-            if len(best_times)==0:
-                return {
-                    "Driver(s)":entity_name,
-                    "Car":car_name,
-                    "Team":team_name,
-                    "Manufacturer":manufacturer_name,
-                    "Average Lap Time":"N/A",
-                    "Computed Laps":0,
-                    "Average Top Speed":"N/A",
-                    "Best Top Speed":"N/A"
-                }
-
-            avg = sum(best_times)/len(best_times)
-
-            avg_str = f"{int(avg//60)}:{avg%60:06.3f}"
-
-            avg_top_speed = subset_sorted.loc[best_idx,"TOP_SPEED"].mean()
-
-            avg_top_speed_str = f"{avg_top_speed:.1f}" if not pd.isna(avg_top_speed) else "N/A"
-
-            best_top_speed = full_subset["TOP_SPEED"].max()
-
-            best_top_speed_str = f"{best_top_speed:.1f}" if not pd.isna(best_top_speed) else "N/A"
-
-            return {
-                "Driver(s)":entity_name,
-                "Car":car_name,
-                "Team":team_name,
-                "Manufacturer":manufacturer_name,
-                "Average Lap Time":avg_str,
-                "Computed Laps":len(best_times),
-                "Average Top Speed":avg_top_speed_str,
-                "Best Top Speed":best_top_speed_str
-            }
+        df_full_session, df_class = filter_laps(df, data_key, target_class, tuple(selected_cars), hour_range)
 
         if avg_by_driver:
-
-            for driver in df_class["DRIVER_NAME"].dropna().unique():
-
-                subset = df_class[df_class["DRIVER_NAME"]==driver]
-
-                full_subset = df_full_session[df_full_session["DRIVER_NAME"]==driver]
-
-                if len(subset)==0:
-                    continue
-
-                car = subset["NUMBER"].iloc[0]
-                team = subset["TEAM"].iloc[0]
-                manufacturer = subset["MANUFACTURER"].iloc[0]
-
-                results.append(process_subset(subset,full_subset,driver,car,team,manufacturer))
-
+            key = "DRIVER_NAME"
         elif avg_by_manufacturer:
-
-            for mfr in df_class["MANUFACTURER"].dropna().unique():
-
-                subset = df_class[df_class["MANUFACTURER"]==mfr]
-
-                full_subset = df_full_session[df_full_session["MANUFACTURER"]==mfr]
-
-                if len(subset)==0:
-                    continue
-
-                results.append(process_subset(subset,full_subset,"All","Multiple","Multiple",mfr))
-
+            key = "MANUFACTURER"
         else:
+            key = "NUMBER"
 
-            for car in sorted(df_class["NUMBER"].dropna().unique(), key=lambda x:int(re.sub(r"\D","",x))):
-
-                subset = df_class[df_class["NUMBER"]==car]
-
-                full_subset = df_full_session[df_full_session["NUMBER"]==car]
-
-                if len(subset)==0:
-                    continue
-
-                team = subset["TEAM"].iloc[0]
-                manufacturer = subset["MANUFACTURER"].iloc[0]
-
-                results.append(process_subset(subset,full_subset,"All",car,team,manufacturer))
-
-        styled_df = pd.DataFrame(results)[[
-            "Car",
-            "Team",
-            "Manufacturer",
-            "Driver(s)",
-            "Average Lap Time",
-            "Computed Laps",
-            "Average Top Speed",
-            "Best Top Speed"
-        ]].reset_index(drop=True)
+        styled_df = compute_results(
+            df_class, df_full_session, (data_key, target_class, tuple(selected_cars), hour_range),
+            key, target_percent, max_delta
+        )
 
         st.dataframe(styled_df, use_container_width=True)
 
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+clock_pattern = r"(?:(\d+):)?(\d{1,2}):(\d{2}\.\d+)"
+non_digit_pattern = r"\D"
+
+
+def parse_clock(series):
+    parts = series.str.extract(clock_pattern).astype("float64")
+    return parts[0].fillna(0), parts[1], parts[2]
+
+
+def sort_car_numbers(cars):
+    # Cars without digits sort last
+    cars = np.asarray(cars)
+    digits = pd.Series(cars, dtype=object).str.replace(non_digit_pattern,"",regex=True)
+    keys = pd.to_numeric(digits, errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    return cars[np.argsort(keys, kind="stable")].tolist()
+
+
+@njit(cache=True)
+def top_laps_stats(lap, top_speed, offsets, target_percent, max_delta):
+    # offsets[i]:offsets[i+1] delimits group i
+    n = offsets.size - 1
+    avg = np.full(n, np.nan)
+    avg_top_speed = np.full(n, np.nan)
+    count = np.zeros(n, np.int64)
+
+    for i in range(n):
+        start, end = offsets[i], offsets[i+1]
+        group_laps = lap[start:end]
+        group_speeds = top_speed[start:end]
+
+        n_valid = (~np.isnan(group_laps)).sum()
+        if n_valid == 0:
+            continue
+
+        # k fastest laps, ties at the cutoff broken by lap order
+        k = min(max(1, int((end-start)*target_percent)), n_valid)
+        if k == n_valid:
+            chosen = ~np.isnan(group_laps)
+        else:
+            kth = np.partition(group_laps, k-1)[k-1]
+
+            faster = group_laps < kth
+            tied = group_laps == kth
+            chosen = faster | (tied & (np.cumsum(tied) <= k - faster.sum()))
+
+        # ...within max_delta of the group's best
+        if max_delta < np.inf:
+            chosen &= group_laps <= np.nanmin(group_laps) + max_delta
+
+        best_laps = group_laps[chosen]
+        avg[i] = best_laps.mean()
+        count[i] = best_laps.size
+
+        speeds = group_speeds[chosen]
+        speeds = speeds[~np.isnan(speeds)]
+        if speeds.size > 0:
+            avg_top_speed[i] = speeds.mean()
+
+    return avg, avg_top_speed, count